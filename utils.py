@@ -1,8 +1,15 @@
 
-import os, requests, random, pickle, zipfile
+import os, requests, random, pickle, zipfile, asyncio, aiohttp, functools, hashlib
 import numpy as np
+import cv2
 import torch, clip
+import torch.nn.functional as F
+from contextlib import nullcontext, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from torch.nn.attention import sdpa_kernel, SDPBackend
+from diffusers.models.attention_processor import AttnProcessor2_0
 from tqdm import tqdm
+from tqdm.asyncio import tqdm as atqdm
 from PIL import Image
 from pycocotools.coco import COCO
 from pytorch_fid import fid_score
@@ -22,6 +29,155 @@ def disable_pipe_bar(f):
     return res
   return wrapper
 
+def _resize(img, size=(299, 299)):
+  '''
+  Resizes PIL image with opencv (INTER_AREA), the same filter as for true COCO images, returns RGB uint8 array
+  '''
+  return cv2.resize(np.asarray(img.convert('RGB')), size, interpolation=cv2.INTER_AREA)
+
+def _save_png(img, path):
+  '''
+  Saves RGB uint8 array as fast (low compression) png, raises OSError if it can not be written
+  '''
+  if not cv2.imwrite(path, cv2.cvtColor(img, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_PNG_COMPRESSION, 1]):
+    raise OSError(f"failed to write {path}")
+
+def _resize_image_file(path_in, path_out, size=(299, 299)):
+  '''
+  Resizes image file with opencv (INTER_AREA), raises cv2.error if image is broken and OSError if it can not be written
+  '''
+  img = cv2.imread(path_in, cv2.IMREAD_COLOR)
+  if not cv2.imwrite(path_out, cv2.resize(img, size, interpolation=cv2.INTER_AREA)):
+    raise OSError(f"failed to write {path_out}")
+
+def patch_scheduler(scheduler):
+  '''
+  Patches scheduler.set_timesteps inplace to also set begin index to 0,
+  so the first step does not search its index with (timesteps == t).nonzero().item(), which is a device sync
+  '''
+  if getattr(scheduler, '_begin_index_patched', False) or not hasattr(scheduler, 'set_begin_index'):
+    return scheduler
+  set_timesteps = scheduler.set_timesteps
+  # keep the original signature: diffusers retrieve_timesteps inspects it for timesteps= / sigmas= support
+  @functools.wraps(set_timesteps)
+  def set_timesteps_from_start(*args, **kwargs):
+    set_timesteps(*args, **kwargs)
+    scheduler.set_begin_index(0)
+  scheduler.set_timesteps = set_timesteps_from_start
+  scheduler._begin_index_patched = True
+  return scheduler
+
+def _fid_stats(activations):
+  '''
+  Returns (mu, sigma) of activations (N, dims) in float64 on cpu, computed on device only on cuda (mps has no float64)
+  '''
+  activations = activations.to('cuda' if activations.device.type == 'cuda' else 'cpu', dtype=torch.float64)
+  return activations.mean(dim=0).cpu(), torch.cov(activations.T).cpu()
+
+def _frechet_distance(mu1, sigma1, mu2, sigma2):
+  '''
+  Frechet distance between two gaussians, same as fid_score.calculate_frechet_distance
+  Tr(sqrtm(sigma1 @ sigma2)) is computed with symmetric eigendecompositions instead of scipy sqrtm
+  '''
+  eigval, eigvec = torch.linalg.eigh(sigma1)
+  sqrt_sigma1 = (eigvec * eigval.clamp(min=0).sqrt()) @ eigvec.T
+  tr_covmean = torch.linalg.eigvalsh(sqrt_sigma1 @ sigma2 @ sqrt_sigma1).clamp(min=0).sqrt().sum()
+  diff = mu1 - mu2
+  return (diff @ diff + sigma1.trace() + sigma2.trace() - 2 * tr_covmean).item()
+
+def channels_last_pipe(pipe):
+  '''
+  Moves pipe.unet and pipe.vae to channels_last (NHWC) memory format inplace
+  '''
+  pipe.unet.to(memory_format=torch.channels_last)
+  pipe.vae.to(memory_format=torch.channels_last)
+  return pipe
+
+def sdpa_pipe(pipe):
+  '''
+  Sets F.scaled_dot_product_attention processor for all pipe.unet attention layers
+  '''
+  pipe.unet.set_attn_processor(AttnProcessor2_0())
+  return pipe
+
+def quantize_unet(pipe, quant='int8'):
+  '''
+  Replaces nn.Linear layers of pipe.unet with bitsandbytes int8 / nf4 layers inplace
+  attention q/k/v projections are kept in fp16 for quality, already quantized layers are skipped
+  unet must be on cuda: bitsandbytes quantizes weights only when they are moved to cuda
+  '''
+  if quant not in ('int8', 'nf4'):
+    raise ValueError(f"quant must be 'int8' or 'nf4', got {quant!r}")
+  if pipe.unet.device.type != 'cuda':
+    raise ValueError(f"quantization requires unet on cuda, got {pipe.unet.device}")
+  import bitsandbytes as bnb
+
+  linears = [
+    (module, name, child) for module in pipe.unet.modules() for name, child in module.named_children()
+    if type(child) is torch.nn.Linear and name not in ('to_q', 'to_k', 'to_v')
+    ]
+  for module, name, linear in linears:
+    device, has_bias = linear.weight.device, linear.bias is not None
+    if quant == 'int8':
+      quantized = bnb.nn.Linear8bitLt(linear.in_features, linear.out_features, bias=has_bias, has_fp16_weights=False, threshold=6.0)
+      quantized.weight = bnb.nn.Int8Params(linear.weight.data.cpu(), requires_grad=False, has_fp16_weights=False)
+    else:
+      quantized = bnb.nn.Linear4bit(linear.in_features, linear.out_features, bias=has_bias, compute_dtype=torch.float16, quant_type='nf4')
+      quantized.weight = bnb.nn.Params4bit(linear.weight.data.cpu(), requires_grad=False, quant_type='nf4')
+    if has_bias:
+      quantized.bias = torch.nn.Parameter(linear.bias.data.cpu(), requires_grad=False)
+    setattr(module, name, quantized.to(device))
+  return pipe
+
+def compile_pipe(pipe, mode='reduce-overhead', fullgraph=True):
+  '''
+  Compiles pipe.unet and pipe.vae.decoder inplace with torch.compile
+  submodules are compiled (not the pipe itself), so compiled modules survive re-wrapping of the pipe
+  already compiled submodules are not wrapped again, so several evaluators can share one pipe
+  shapes are static (dynamic=False): with mode='reduce-overhead' every call is captured into a CUDA graph once per shape
+  '''
+  compile_kwargs = dict(mode=mode, fullgraph=fullgraph, dynamic=False)
+
+  channels_last_pipe(pipe)
+  for owner, name in ((pipe, 'unet'), (pipe.vae, 'decoder')):
+    module = getattr(owner, name)
+    if not hasattr(module, '_orig_mod'):
+      setattr(owner, name, torch.compile(module, **compile_kwargs))
+  return pipe
+
+@contextmanager
+def uncompiled_pipe(pipe):
+  '''
+  Temporarily swaps compiled pipe.unet / pipe.vae.decoder back to the original modules
+  (profiler with_flops counts only aten ops, not inductor kernels replayed from CUDA graphs)
+  '''
+  compiled = [
+    (owner, name, getattr(owner, name)) for owner, name in ((pipe, 'unet'), (pipe.vae, 'decoder'))
+    if hasattr(getattr(owner, name), '_orig_mod')
+    ]
+  for owner, name, module in compiled:
+    setattr(owner, name, module._orig_mod)
+  try:
+    yield pipe
+  finally:
+    for owner, name, module in compiled:
+      setattr(owner, name, module)
+
+# fused SDPA kernels only (no math fallback), used around pipe calls on cuda
+SDPA_BACKENDS = [SDPBackend.CUDNN_ATTENTION, SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION]
+
+# CLIP image normalization, see clip/clip.py _transform
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD  = (0.26862954, 0.26130258, 0.27577711)
+# full resolution images per gpu preprocessing step (e.g. 16 SDXL 1024x1024 images ~ 200MB in float32)
+CLIP_PREPROCESS_BATCH_SIZE = 16
+
+# inception pool3 features for FID, inception runs on static batches of FID_BATCH_SIZE
+FID_DIMS = 2048
+FID_BATCH_SIZE = 64
+# filter used to resize true & generated images to 299x299 (see _resize), bump if it changes
+FID_RESIZE = 'cv2.INTER_AREA'
+
 # ==================================================================================================
 # COCO ANNOTATIONS & IMGS
 # ==================================================================================================
@@ -29,14 +185,52 @@ COCO_ANNOTATIONS = 'http://images.cocodataset.org/annotations/annotations_trainv
 COCO_IMGS = 'annotations/instances_train2017.json'
 COCO_ANNS = 'annotations/captions_train2017.json'
 
+async def _fetch_all(urls, paths, max_connections=64, retries=5, timeout=60):
+  '''
+  Downloads urls to paths with up to max_connections concurrent requests
+  failed requests (http errors, timeouts) are retried with exponential backoff, files are written only on success
+  '''
+  timeout = aiohttp.ClientTimeout(total=timeout)
+  async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=max_connections), timeout=timeout) as session:
+    async def fetch(url, path):
+      for attempt in range(retries):
+        try:
+          async with session.get(url) as resp:
+            resp.raise_for_status()
+            data = await resp.read()
+          break
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+          if attempt == retries - 1:
+            tqdm.write(f"Failed to download {url}: {e!r}")
+            return
+          await asyncio.sleep(2 ** attempt)
+      with open(f"{path}.tmp", 'wb') as f:
+        f.write(data)
+      os.replace(f"{path}.tmp", path)
+    await atqdm.gather(*[fetch(url, path) for url, path in zip(urls, paths)], desc='Downloading images')
+
+def _run_async(coro):
+  '''
+  Runs coroutine to completion, on a private loop in a worker thread if a loop is already running (e.g. jupyter)
+  '''
+  try:
+    asyncio.get_running_loop()
+  except RuntimeError:
+    return asyncio.run(coro)
+  with ThreadPoolExecutor(max_workers=1) as pool:
+    return pool.submit(asyncio.run, coro).result()
+
 def download_COCO(N_ann, N_fid, path_coco='coco_data', seed=42):
   '''
   Downloads and extracts MSCOCO dataset including N_fid images
-  Return N_ann annotations
+  original jpg images are kept in path_coco/imgs_coco_jpg, 299x299 png copies for FID in path_coco/imgs_coco
+  Return N_ann captions (one per image)
   '''
   path_coco_imgs = os.path.join(path_coco, 'imgs_coco')
+  path_coco_jpgs = os.path.join(path_coco, 'imgs_coco_jpg')
   os.makedirs(path_coco, exist_ok=True)
   os.makedirs(path_coco_imgs, exist_ok=True)
+  os.makedirs(path_coco_jpgs, exist_ok=True)
   
   # download annotations & img_ids
   if not os.path.exists(os.path.join(path_coco, 'annotations')):
@@ -62,27 +256,38 @@ def download_COCO(N_ann, N_fid, path_coco='coco_data', seed=42):
     with open(img_ids_path, 'wb') as f:
       pickle.dump(img_ids, f)
 
-  # load annotations
+  # load annotations, one caption per image chosen deterministically by img_id
   coco_prompts = COCO(os.path.join(path_coco, COCO_ANNS))
-  ann_ids = coco_prompts.getAnnIds(imgIds=img_ids[:N_ann])
-  prompts = coco_prompts.loadAnns(ann_ids)
+  prompts = [random.Random(img_id).choice(coco_prompts.imgToAnns[img_id])['caption'] for img_id in img_ids[:N_ann]]
 
-  # download images
-  already_downloaded = set(os.listdir(path_coco_imgs))
-  imgs_to_download = coco_imgs.loadImgs(img_ids[-N_fid:])
-  imgs_to_download = [img for img in imgs_to_download if f"{img['id']}.png" not in already_downloaded]
-  for img in tqdm(imgs_to_download, desc='Downloading images'):
-    img_url = img['coco_url']
-    img_data = requests.get(img_url).content
+  # 299x299 pngs resized with another filter (e.g. PIL LANCZOS of older versions) are redone from jpgs
+  path_resize_tag = os.path.join(path_coco, 'imgs_coco_resize.txt')
+  resize_tag = open(path_resize_tag).read() if os.path.exists(path_resize_tag) else None
+  already_resized = set(os.listdir(path_coco_imgs)) if resize_tag == FID_RESIZE else set()
 
-    with open(os.path.join(path_coco_imgs, f"{img['id']}.png"), 'wb') as f:
-      f.write(img_data)
+  # download original jpg images (skip those already downloaded or resized)
+  already_downloaded = set(os.listdir(path_coco_jpgs))
+  imgs_to_download = coco_imgs.loadImgs(img_ids[-N_fid:])
+  imgs_to_download = [img for img in imgs_to_download if f"{img['id']}.jpg" not in already_downloaded and f"{img['id']}.png" not in already_resized]
+  _run_async(_fetch_all(
+    [img['coco_url'] for img in imgs_to_download],
+    [os.path.join(path_coco_jpgs, f"{img['id']}.jpg") for img in imgs_to_download],
+    ))
   
-  # resize all images to 299x299
-  for img_id in tqdm(img_ids[-N_fid:], desc='Resizing images'):
-    img_path = os.path.join(path_coco_imgs, f"{img_id}.png")
-    with Image.open(img_path) as img:
-      img.resize((299, 299), Image.LANCZOS).save(img_path)
+  # resize images to 299x299 png, undecodable jpgs are deleted to be downloaded again on next call
+  imgs_to_resize = [img_id for img_id in img_ids[-N_fid:] if f"{img_id}.png" not in already_resized]
+  for img_id in tqdm(imgs_to_resize, desc='Resizing images'):
+    jpg_path, png_path = os.path.join(path_coco_jpgs, f"{img_id}.jpg"), os.path.join(path_coco_imgs, f"{img_id}.png")
+    if not os.path.exists(jpg_path):
+      # download failed: drop png left from another resize filter, it is redone on next call
+      if os.path.exists(png_path): os.remove(png_path)
+      continue
+    try:
+      _resize_image_file(jpg_path, png_path)
+    except cv2.error:
+      os.remove(jpg_path)
+  with open(path_resize_tag, 'w') as f:
+    f.write(FID_RESIZE)
   
   return prompts
 
@@ -95,8 +300,9 @@ def validate_coco_images(path_coco_imgs='coco_data/imgs_coco'):
     img_path = os.path.join(path_coco_imgs, img)
     try:
       with Image.open(img_path) as img:
-        if img.size != (299, 299):
-          img.resize((299, 299), Image.LANCZOS).save(img_path)
+        img_size = img.size
+      if img_size != (299, 299):
+        _resize_image_file(img_path, img_path)
     except:
       os.remove(img_path)
 
@@ -107,55 +313,226 @@ class SDEvaluator:
   '''
   Class for gathering CLIP and FID statistics for Diffusion pipeline
   '''
-  def __init__(self, model, device = None, clip_model = 'ViT-B/32'):
+  def __init__(self, model, device = None, clip_model = 'ViT-B/32', channels_last = False, fused_attention = False, quant = 'none', compile_model = False):
     self.model = model
-    self.device = device or torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    self.device = torch.device(device or ('cuda' if torch.cuda.is_available() else 'cpu'))
     self.clip_model,  self.clip_preprocess = clip.load(clip_model)
-    self.clip_model = self.clip_model.to(self.device).eval()
+    self.clip_dtype = torch.bfloat16 if self.device.type == 'cuda' else torch.float32
+    self.clip_model = self.clip_model.to(self.device, dtype=self.clip_dtype).eval()
+    self._clip_mean = torch.tensor(CLIP_MEAN, device=self.device).view(1, 3, 1, 1)
+    self._clip_std  = torch.tensor(CLIP_STD, device=self.device).view(1, 3, 1, 1)
+    self._clip_text_stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+    self._clip_tokens = {}
+    self.inception_dtype = torch.bfloat16 if self.device.type == 'cuda' else torch.float32
+    self.inception = None  # built on first FID use, see _get_inception_features
+    self._fid_real_stats = {}
+    self._pinned = {}
+    self._io_pool = ThreadPoolExecutor(max_workers=4)
+
+    self.fused_attention = fused_attention and self.device.type == 'cuda'
+    torch.backends.cudnn.benchmark = True
+    torch.set_float32_matmul_precision('high')
+
+    if channels_last:
+      channels_last_pipe(self.model)
+    if self.fused_attention:
+      sdpa_pipe(self.model)
+    if quant != 'none':
+      quantize_unet(self.model, quant)
+    if compile_model:
+      # bitsandbytes layers break the graph, so fullgraph is only requested for fp16 unet
+      compile_pipe(self.model, fullgraph=quant == 'none')
+      self._warmup()
   
   def generate(self, *args, **kwargs):
-    return self.model(*args, **kwargs).images[0]
+    patch_scheduler(self.model.scheduler)
+    with torch.inference_mode(), sdpa_kernel(SDPA_BACKENDS) if self.fused_attention else nullcontext():
+      return self.model(*args, **kwargs).images[0]
+
+  @disable_pipe_bar
+  def _warmup(self, **kwargs):
+    '''
+    One dummy generation, so compilation cost is not paid inside CLIP / FID / Tflops
+    '''
+    self.generate('warmup', **kwargs)
   
 
-  def _get_clip_score(self, image, caption):
+  def _upload(self, arrays, name):
+    '''
+    Stacks same-shape numpy arrays and copies them to device,
+    on cuda they are stacked directly into reusable pinned buffer `name` and copied non_blocking
+    buffer is overwritten only after previous copy from it has finished
+    '''
+    if self.device.type != 'cuda':
+      return torch.from_numpy(np.stack(arrays)).to(self.device)
+
+    shape, dtype = (len(arrays), *arrays[0].shape), torch.from_numpy(arrays[0][:0]).dtype
+    numel = int(np.prod(shape))
+    buffer, copied = self._pinned.get(name, (None, None))
+    if buffer is None or buffer.dtype != dtype or buffer.numel() < numel:
+      buffer, copied = torch.empty(numel, dtype=dtype, pin_memory=True), torch.cuda.Event()
+    copied.synchronize()
+    staged = buffer[:numel].view(shape)
+    np.stack(arrays, out=staged.numpy())
+    tensor = staged.to(self.device, non_blocking=True)
+    copied.record(torch.cuda.current_stream(self.device))
+    self._pinned[name] = (buffer, copied)
+    return tensor
+
+  def _clip_preprocess_batch(self, images):
+    '''
+    Batched gpu version of self.clip_preprocess: resize shorter side (bicubic), center crop, normalize
+    all images should have the same size
+    full resolution images are uploaded in sub-batches of CLIP_PREPROCESS_BATCH_SIZE to bound gpu and pinned memory
+    '''
+    size = self.clip_model.visual.input_resolution
+    image_inputs = []
+    for start in range(0, len(images), CLIP_PREPROCESS_BATCH_SIZE):
+      sub_batch = [np.asarray(image.convert('RGB')) for image in images[start:start+CLIP_PREPROCESS_BATCH_SIZE]]
+      image_input = self._upload(sub_batch, 'clip').permute(0, 3, 1, 2).float() / 255
+
+      h, w = image_input.shape[-2:]
+      new_h, new_w = (size, int(size * w / h)) if h <= w else (int(size * h / w), size)
+      image_input = F.interpolate(image_input, size=(new_h, new_w), mode='bicubic', antialias=True).clamp(0, 1)
+      top, left = int(round((new_h - size) / 2)), int(round((new_w - size) / 2))
+      image_inputs.append(image_input[..., top:top+size, left:left+size])
+
+    image_input = (torch.cat(image_inputs) - self._clip_mean) / self._clip_std
+    return image_input.to(self.clip_dtype)
+
+  def _get_clip_tokens(self, captions):
     '''
-    Returns CLIP score for one image and one caption
+    Returns CLIP tokens (N, 77) for captions, tokenized once and kept (pinned on cuda) for the last captions list
+    '''
+    key = tuple(captions)
+    if key not in self._clip_tokens:
+      tokens = clip.tokenize(captions)
+      self._clip_tokens = {key: tokens.pin_memory() if self.device.type == 'cuda' else tokens}
+    return self._clip_tokens[key]
+
+  def _get_clip_scores(self, images, tokens):
+    '''
+    Returns CLIP scores for a batch of images and tokenized captions (i-th image with i-th caption)
     see https://github.com/Taited/clip-score/blob/master/src/clip_score/clip_score.py
     '''
-    image_input = self.clip_preprocess(image).unsqueeze(0).to(self.device)
-    text_input  = clip.tokenize([caption]).to(self.device)
+    image_input = self._clip_preprocess_batch(images)
+    text_input  = tokens.to(self.device, non_blocking=True)
+
+    # on cuda text encoder runs on a side stream, concurrently with image encoder
+    text_stream = self._clip_text_stream
+    if text_stream is not None:
+      text_stream.wait_stream(torch.cuda.current_stream(self.device))
+      text_input.record_stream(text_stream)
+
+    with torch.inference_mode(), torch.autocast(self.device.type, dtype=self.clip_dtype, enabled=self.clip_dtype != torch.float32):
+      with torch.cuda.stream(text_stream) if text_stream is not None else nullcontext():
+        text_features = self.clip_model.encode_text(text_input).float()
+      image_features = self.clip_model.encode_image(image_input).float()
 
-    with torch.no_grad():
-      image_features = self.clip_model.encode_image(image_input)
-      text_features  = self.clip_model.encode_text(text_input)
+    if text_stream is not None:
+      torch.cuda.current_stream(self.device).wait_stream(text_stream)
+      text_features.record_stream(torch.cuda.current_stream(self.device))
     image_features = image_features / image_features.norm(dim=-1, keepdim=True)
     text_features  = text_features / text_features.norm(dim=-1, keepdim=True)
 
-    clip_score = torch.matmul(image_features, text_features.T).item()
-    return clip_score
+    clip_scores = (image_features * text_features).sum(dim=-1)
+    return clip_scores
 
   @disable_pipe_bar
-  def CLIP(self, annotations, path_gen_img=None, verbose=True, **kwargs):
-    '''
-    Generates conditional images and calculates CLIP on MSCOCO dataset
-    '''
-    clip_scores = []
-    n_generated = len(os.listdir(path_gen_img)) if os.path.exists(path_gen_img) else 0
-    for i, prompt in tqdm(enumerate(annotations[n_generated:]), desc="CLIP", total=len(annotations), disable = not verbose):
-      torch.manual_seed(i)
-      img_gen_cond = self.generate(prompt, **kwargs) 
-      clip_gen = self._get_clip_score(img_gen_cond, prompt)
-      if path_gen_img is not None: clip_gen.save(os.path.join(path_gen_img, f"{i}.png"))
-      clip_scores.append(float(clip_gen))
-    return np.mean(clip_scores)
+  def CLIP(self, captions, path_gen_img=None, verbose=True, batch_size=128, **kwargs):
+    '''
+    Generates conditional images for captions (e.g. from download_COCO) and calculates CLIP on MSCOCO dataset
+    images are generated one by one, but scored with CLIP in batches of batch_size
+    scores stay on device until the end, so there is a single device sync
+    all captions are always scored, if path_gen_img is not None generated images are saved there as {i}.png
+    '''
+    if path_gen_img is not None: os.makedirs(path_gen_img, exist_ok=True)
+    tokens = self._get_clip_tokens(captions)
+    clip_scores = torch.empty(len(captions), device=self.device)
+    with tqdm(desc="CLIP", total=len(captions), disable = not verbose) as pbar:
+      for start in range(0, len(captions), batch_size):
+        prompts, imgs_gen_cond = captions[start:start+batch_size], []
+        for i, prompt in enumerate(prompts, start):
+          torch.manual_seed(i)
+          img_gen_cond = self.generate(prompt, **kwargs)
+          if path_gen_img is not None: img_gen_cond.save(os.path.join(path_gen_img, f"{i}.png"))
+          imgs_gen_cond.append(img_gen_cond)
+          pbar.update()
+        clip_scores[start:start+len(prompts)] = self._get_clip_scores(imgs_gen_cond, tokens[start:start+len(prompts)])
+        del imgs_gen_cond
+    return clip_scores.mean().item()
   
+  def _get_inception_features(self, image_input):
+    '''
+    Returns inception pool3 features (float32) for list of N uint8 (299, 299, 3) arrays, N <= FID_BATCH_SIZE
+    batch is padded to FID_BATCH_SIZE, so compiled inception always sees the same shape
+    inception is created (and compiled on cuda) lazily, so evaluators that never run FID do not pay for it
+    '''
+    if self.inception is None:
+      self.inception = fid_score.InceptionV3([fid_score.InceptionV3.BLOCK_INDEX_BY_DIM[FID_DIMS]]).to(self.device, dtype=self.inception_dtype).eval()
+      if self.device.type == 'cuda':
+        self.inception = torch.compile(self.inception, mode='reduce-overhead')
+
+    n_img = len(image_input)
+    image_input = self._upload(image_input, 'fid').permute(0, 3, 1, 2).float() / 255
+    image_input = F.pad(image_input, (0, 0, 0, 0, 0, 0, 0, FID_BATCH_SIZE - n_img))
+
+    with torch.inference_mode():
+      features = self.inception(image_input.to(self.inception_dtype))[0]
+    return features[:n_img].flatten(start_dim=1).float()
+
+  def _fid_activations(self, images, n_img, verbose=False, desc=None):
+    '''
+    Returns inception activations (n_img, FID_DIMS) on device for iterable of n_img uint8 (299, 299, 3) arrays,
+    in batches of FID_BATCH_SIZE
+    '''
+    activations = torch.empty((n_img, FID_DIMS), device=self.device)
+    batch, start = [], 0
+    for image in tqdm(images, desc=desc, total=n_img, disable=not verbose):
+      batch.append(image)
+      if len(batch) == FID_BATCH_SIZE or start + len(batch) == n_img:
+        activations[start:start+len(batch)] = self._get_inception_features(batch)
+        batch, start = [], start + len(batch)
+    return activations
+
+  def _get_real_fid_stats(self, path_true_img):
+    '''
+    Returns (mu, sigma) of inception features of true images
+    stats are cached in memory and on disk next to path_true_img, and recomputed if image files
+    (names, modification times), resize filter or inception dtype changed
+    '''
+    if path_true_img not in self._fid_real_stats:
+      img_names = sorted(os.listdir(path_true_img))
+      max_mtime = max((os.stat(os.path.join(path_true_img, img_name)).st_mtime_ns for img_name in img_names), default=0)
+      names_hash = hashlib.sha1('\n'.join(img_names).encode()).hexdigest()
+      key = f"{FID_RESIZE}|{self.inception_dtype}|{max_mtime}|{names_hash}"
+
+      path_stats = f"{os.path.normpath(path_true_img)}_fid_stats.npz"
+      try:
+        with np.load(path_stats) as stats:
+          stats = dict(stats)
+      except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+        stats = {}
+      if {'mu', 'sigma'} <= stats.keys() and str(stats.get('key')) == key:
+        mu, sigma = torch.from_numpy(stats['mu']), torch.from_numpy(stats['sigma'])
+      else:
+        images = (_resize(Image.open(os.path.join(path_true_img, img_name))) for img_name in img_names)
+        mu, sigma = _fid_stats(self._fid_activations(images, len(img_names)))
+        # parallel evaluators share path_stats: write to own tmp file, then atomically replace
+        path_tmp = f"{path_stats}.{os.getpid()}.tmp.npz"
+        np.savez(path_tmp, mu=mu.numpy(), sigma=sigma.numpy(), key=key)
+        os.replace(path_tmp, path_stats)
+      self._fid_real_stats[path_true_img] = (mu, sigma)
+    return self._fid_real_stats[path_true_img]
+
   @disable_pipe_bar
   def FID(self, path_gen_img, path_true_img, verbose=True, **kwargs):
     '''
-    Generates unconditional small images and calculates FID
-    if delete_gen_after is True, generated images will be deleted after FID calculation
+    Generates unconditional images and calculates FID against images in path_true_img
+    inception features of generated images are computed in memory,
+    if path_gen_img is not None, generated images are also saved there (299x299)
     '''
-    os.makedirs(path_gen_img, exist_ok=True)
+    if path_gen_img is not None: os.makedirs(path_gen_img, exist_ok=True)
 
     # unconditional generation
     default_kwargs = dict(
@@ -164,27 +541,34 @@ class SDEvaluator:
     )
     default_kwargs.update(kwargs)
 
-    # gen & resize loop:
-    n_true_img  = len(os.listdir(path_true_img))
-    n_generated = len(os.listdir(path_gen_img))
-    for i in tqdm(range(n_generated, n_true_img), desc="FID", disable=not verbose):
-      torch.manual_seed(i)
-      img_gen_uncond = self.generate(**default_kwargs)
-      img_gen_uncond = img_gen_uncond.resize((299, 299), Image.LANCZOS)
-      img_gen_uncond.save(os.path.join(path_gen_img, f"{i}.png"))
+    # gen & resize loop (same filter as true images), (optional) save in background threads:
+    saved = []
+    def generate_images(n_img):
+      for i in range(n_img):
+        torch.manual_seed(i)
+        img_gen_uncond = _resize(self.generate(**default_kwargs))
+        if path_gen_img is not None:
+          saved.append(self._io_pool.submit(_save_png, img_gen_uncond, os.path.join(path_gen_img, f"{i}.png")))
+        yield img_gen_uncond
+
+    # inception features on gpu in batches
+    n_true_img = len(os.listdir(path_true_img))
+    activations = self._fid_activations(generate_images(n_true_img), n_true_img, verbose=verbose, desc="FID")
+    for future in saved: future.result()
     
     # FID stat
-    fid_params = {'batch_size': 16, 'num_workers': 1, 'device': self.device, 'dims': 2048}
-    fid_value = fid_score.calculate_fid_given_paths([path_true_img, path_gen_img], **fid_params)
+    mu_gen, sigma_gen = _fid_stats(activations)
+    mu_true, sigma_true = self._get_real_fid_stats(path_true_img)
+    fid_value = _frechet_distance(mu_true, sigma_true, mu_gen, sigma_gen)
     return fid_value
   
   @disable_pipe_bar
   def Tflops(self, prompt=None, **kwargs):
     '''
-    Count Tflops
+    Count Tflops, compiled modules are profiled uncompiled
     '''
     prompt = prompt or "a photograph of an astronaut riding a horse"
-    with profile(activities=[ProfilerActivity.CPU, ProfilerActivity.CUDA], record_shapes=True, with_flops=True) as prof:
+    with uncompiled_pipe(self.model), profile(activities=[ProfilerActivity.CPU, ProfilerActivity.CUDA], record_shapes=True, with_flops=True) as prof:
       with record_function("model_inference"):
         self.generate(prompt, **kwargs)
     